@@ -1,127 +1,533 @@
 import os
 import re
+import glob
+import json
+import time
+import sqlite3
+import shutil
+import subprocess
+import hashlib
 import logging
+import threading
+import collections
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 import yt_dlp
-from concurrent.futures import ThreadPoolExecutor
+from ytmusicapi import YTMusic
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3NoHeaderError
+import atexit
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Parse JSON with orjson when it's available. Spotipy (through requests) and yt_dlp
+# both go through json.loads, so patching it speeds up every response they decode.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _json_loads = json.loads
+
+    def _fast_loads(s, *args, **kwargs):
+        # orjson has no hooks or custom decoders, leave those calls to the stdlib
+        if args or kwargs:
+            return _json_loads(s, *args, **kwargs)
+        return orjson.loads(s)
+
+    json.loads = _fast_loads
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("spotify_downloader")
 
+# On-disk cache for Spotify responses and resolved YouTube URLs
+CACHE_PATH = os.path.join(os.getcwd(), "cache.db")
+# Tracks and albums don't change, playlists do
+CACHE_TTL = {
+    "track": 30 * 86400,
+    "tracks": 30 * 86400,
+    "album": 30 * 86400,
+    "album_tracks": 30 * 86400,
+    "playlist": 86400,
+}
+YT_CACHE_TTL = 30 * 86400
+
+_cache_lock = threading.Lock()
+_cache_conn = None
+
+def get_cache():
+    """Open (and create if needed) the SQLite cache database, shared by all threads."""
+    global _cache_conn
+    with _cache_lock:
+        if _cache_conn is None:
+            _cache_conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+            _cache_conn.execute("CREATE TABLE IF NOT EXISTS spotify_obj ("
+                                "id TEXT PRIMARY KEY, kind TEXT, json BLOB, fetched_at INT)")
+            _cache_conn.execute("CREATE TABLE IF NOT EXISTS yt_resolve ("
+                                "query_hash TEXT PRIMARY KEY, webpage_url TEXT, fetched_at INT)")
+            _cache_conn.commit()
+        return _cache_conn
+
+def cached_call(kind, obj_id, fn):
+    """
+    Return the cached Spotify response for (kind, obj_id) if it is still fresh,
+    otherwise call fn(), store its result and return it.
+    """
+    conn = get_cache()
+    key = f"{kind}:{obj_id}"
+    with _cache_lock:
+        row = conn.execute("SELECT json, fetched_at FROM spotify_obj WHERE id = ?", (key,)).fetchone()
+    if row and time.time() - row[1] < CACHE_TTL.get(kind, 86400):
+        return json.loads(row[0])
+    result = fn()
+    with _cache_lock:
+        conn.execute("INSERT OR REPLACE INTO spotify_obj VALUES (?, ?, ?, ?)",
+                     (key, kind, json.dumps(result), int(time.time())))
+        conn.commit()
+    return result
+
+def query_hash(query):
+    """Hash a search query for use as a cache key."""
+    return hashlib.blake2b(query.encode()).hexdigest()
+
+def get_cached_url(query):
+    """Return the previously resolved YouTube URL for a search query, or None."""
+    conn = get_cache()
+    with _cache_lock:
+        row = conn.execute("SELECT webpage_url, fetched_at FROM yt_resolve WHERE query_hash = ?",
+                           (query_hash(query),)).fetchone()
+    if row and time.time() - row[1] < YT_CACHE_TTL:
+        return row[0]
+    return None
+
+def set_cached_url(query, url):
+    """Remember the YouTube URL a search query resolved to."""
+    conn = get_cache()
+    with _cache_lock:
+        conn.execute("INSERT OR REPLACE INTO yt_resolve VALUES (?, ?, ?)",
+                     (query_hash(query), url, int(time.time())))
+        conn.commit()
+
+def delete_cached_url(query):
+    """Forget the YouTube URL cached for a search query."""
+    conn = get_cache()
+    with _cache_lock:
+        conn.execute("DELETE FROM yt_resolve WHERE query_hash = ?", (query_hash(query),))
+        conn.commit()
+
+_SPOTIFY_URL_RE = re.compile(r"open\.spotify\.com/(track|album|playlist)/([a-zA-Z0-9]+)")
+# Characters that are not allowed in filenames, mapped to None for str.translate
+_BAD_CHARS_TABLE = str.maketrans("", "", '\\/*?:"<>|')
+
 def extract_spotify_id(url):
     """
     Extract the Spotify type and ID from a Spotify URL.
     Returns a tuple (url_type, spotify_id) where url_type is one of "track", "album", or "playlist".
     """
-    regex = r"open\.spotify\.com/(track|album|playlist)/([a-zA-Z0-9]+)"
-    match = re.search(regex, url)
+    match = _SPOTIFY_URL_RE.search(url)
     if match:
         return match.group(1), match.group(2)
     return None, None
 
-def build_query(track):
-    """Build a search query using the track's artist(s) and title with 'official audio' appended."""
-    artist = ", ".join([a["name"] for a in track.get("artists", [])])
+TrackMeta = collections.namedtuple("TrackMeta", "id artist title query base_filename")
+
+def to_meta(track):
+    """
+    Extract everything the download needs from a Spotify track object once:
+    the artist(s), the title, the search query (with 'official audio' appended) and the file name.
+    """
+    artist = ", ".join(a["name"] for a in track.get("artists", []))
     title = track.get("name", "")
-    return f"{artist} - {title} official audio"
+    return TrackMeta(track.get("id"), artist, title,
+                     f"{artist} - {title} official audio",
+                     sanitize_filename(f"{artist} - {title}"))
 
 def sanitize_filename(name):
     """Remove illegal characters from a filename."""
-    return re.sub(r'[\\/*?:"<>|]', "", name)
+    return name.translate(_BAD_CHARS_TABLE)
 
-def download_song(query, downloads_dir, base_filename, ffmpeg_path="ast"):
+# Per-track time limit, so one stuck track can't hold a worker for the whole run
+DEFAULT_TRACK_TIMEOUT = 300
+_track_timeout = DEFAULT_TRACK_TIMEOUT
+
+def set_track_timeout(seconds):
+    """Set the maximum number of seconds a single track may take (0 disables the limit)."""
+    global _track_timeout
+    _track_timeout = seconds
+
+def make_deadline_hook(deadline):
     """
-    Download a song using yt_dlp.
-    Uses an output template so that the final file is named <base_filename>.mp3.
-    Returns the full path of the downloaded file (or None if it fails).
+    Return a yt_dlp progress hook that aborts the current download once deadline["at"] has passed.
+    The deadline is shared through the closure rather than a thread-local, because fragment
+    downloads call progress hooks from their own threads.
     """
-    output_template = os.path.join(downloads_dir, f"{base_filename}.%(ext)s")
-    final_filename = f"{base_filename}.mp3"
-    final_path = os.path.join(downloads_dir, final_filename)
-    
-    ydl_opts = {
+    def check_deadline(status):
+        # Only cut off transfers still in progress, a download that finishes just after the deadline is kept.
+        # DownloadCancelled is not a DownloadError, so fragment downloads can't skip past it
+        # and leave a truncated file behind.
+        at = deadline["at"]
+        if status.get("status") == "downloading" and at is not None and time.monotonic() > at:
+            raise yt_dlp.utils.DownloadCancelled(f"Timed out after {_track_timeout} seconds")
+    return check_deadline
+
+def deadline_passed():
+    """Return True if the track this thread is downloading has run past its deadline."""
+    deadline = getattr(_ydl_local, "deadline", None)
+    return deadline is not None and deadline["at"] is not None and time.monotonic() > deadline["at"]
+
+def remove_partial_download(downloads_dir, base_filename):
+    """Delete the leftovers (<base_filename>.<ext>, .part and fragment files) of an unfinished download."""
+    pattern = os.path.join(glob.escape(downloads_dir), glob.escape(base_filename) + ".*")
+    for path in glob.glob(pattern):
+        if not path.endswith(".mp3"):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Could not remove {path}: {e}")
+
+# Hand the byte transfer to aria2c (multiple connections per file) when enabled
+_use_aria2 = False
+
+def enable_aria2():
+    """Use aria2c as the external downloader if it is on PATH. Returns whether it was enabled."""
+    global _use_aria2
+    _use_aria2 = shutil.which("aria2c") is not None
+    if not _use_aria2:
+        logger.warning("aria2c not found on PATH, using the native downloader.")
+    return _use_aria2
+
+def make_ydl_opts(ffmpeg_path="ast"):
+    """Build the yt_dlp options shared by every download."""
+    opts = {
         "format": "bestaudio/best",
-        "outtmpl": output_template,
         "noplaylist": True,
         "quiet": True,
         "ffmpeg_location": ffmpeg_path,
         "retries": 3,
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "192"
-        }],
+        # Give up on a stalled connection instead of blocking the worker forever
+        "socket_timeout": 30,
+        # Fetch DASH/HLS fragments in parallel, and plain files in 10 MiB ranges
+        "concurrent_fragment_downloads": 4,
+        "http_chunk_size": 10 * 1024 * 1024,
+        # Conversion to mp3 is done separately by convert_to_mp3, so download threads stay on the network
+        "postprocessors": [],
+        "keepvideo": False,
     }
+    if _use_aria2:
+        opts["external_downloader"] = "aria2c"
+        # yt_dlp gets no progress from aria2c, so the track deadline can't stop it.
+        # Let aria2c give up on stalled or crawling transfers itself instead.
+        opts["external_downloader_args"] = {
+            "aria2c": ["-x", "8", "-s", "8", "-k", "1M", "--console-log-level=warn",
+                       "--timeout=30", "--max-tries=3", "--lowest-speed-limit=10K"]
+        }
+    return opts
+
+# One YoutubeDL per worker thread, reused for every track that thread downloads.
+# Building an instance loads all extractors and a fresh HTTP pool, so we only do it once.
+_ydl_local = threading.local()
+
+def get_ydl(ffmpeg_path="ast"):
+    """Return this thread's YoutubeDL instance, creating it on first use."""
+    ydl = getattr(_ydl_local, "ydl", None)
+    if ydl is None:
+        # Each instance gets its own deadline, set by download_song before every track
+        deadline = {"at": None}
+        opts = make_ydl_opts(ffmpeg_path)
+        opts["progress_hooks"] = [make_deadline_hook(deadline)]
+        ydl = yt_dlp.YoutubeDL(opts)
+        atexit.register(ydl.close)
+        _ydl_local.ydl = ydl
+        _ydl_local.deadline = deadline
+    return ydl
+
+# Pace YouTube searches so large playlists don't trigger rate limiting / captchas.
+# Only the search is throttled, downloads themselves still run concurrently.
+DEFAULT_WORKERS = 4
+DEFAULT_SEARCH_RPS = 2.0
+_search_lock = threading.Lock()
+_search_interval = 1.0 / DEFAULT_SEARCH_RPS
+_next_search = 0.0
+
+def set_search_rate(rps):
+    """Set the maximum number of YouTube searches per second (0 disables the limit)."""
+    global _search_interval
+    _search_interval = 1.0 / rps if rps > 0 else 0.0
+
+def wait_for_search_slot():
+    """Block until the next YouTube search is allowed to start."""
+    global _next_search
+    with _search_lock:
+        now = time.monotonic()
+        wait = _next_search - now
+        _next_search = max(now, _next_search) + _search_interval
+    if wait > 0:
+        time.sleep(wait)
+
+_ytmusic_local = threading.local()
+
+def search_youtube_music(query):
+    """
+    Look up a song through the YouTube Music JSON API.
+    Returns the watch URL of the best match, or None if nothing was found.
+    """
+    yt = getattr(_ytmusic_local, "yt", None)
+    if yt is None:
+        yt = _ytmusic_local.yt = YTMusic()
+    hits = yt.search(query, filter="songs", limit=1)
+    for hit in hits:
+        if hit.get("videoId"):
+            return f"https://music.youtube.com/watch?v={hit['videoId']}"
+    return None
+
+def already_downloaded(path):
+    """Return True if the file exists and is not empty."""
+    return os.path.isfile(path) and os.path.getsize(path) > 0
+
+def download_song(query, downloads_dir, base_filename, ffmpeg_path="ast"):
+    """
+    Download the audio for a song using yt_dlp, without converting it.
+    Uses an output template so that the file is named <base_filename>.<ext>.
+    Returns the full path of the downloaded file, the existing <base_filename>.mp3
+    if the song is already there, or None if it fails.
+    """
+    output_template = os.path.join(downloads_dir, f"{base_filename}.%(ext)s")
+    final_filename = f"{base_filename}.mp3"
+    final_path = os.path.join(downloads_dir, final_filename)
+    if already_downloaded(final_path):
+        logger.info(f"Skip existing {final_path}")
+        return final_path
+
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info("ytsearch:" + query, download=False)
-            if "entries" in info and len(info["entries"]) > 0:
-                video = info["entries"][0]
-                video_url = video.get("webpage_url")
+        ydl = get_ydl(ffmpeg_path)
+        ydl.params["outtmpl"]["default"] = output_template
+        _ydl_local.deadline["at"] = time.monotonic() + _track_timeout if _track_timeout > 0 else None
+        entry = None
+        video_url = get_cached_url(query)
+        if video_url:
+            logger.info(f"Cached video: {video_url}")
+            # Extract first and download separately, so only a failed extraction counts as a dead URL
+            try:
+                info = ydl.extract_info(video_url, download=False)
+            except Exception as e:
+                if deadline_passed():
+                    raise
+                # The video may have been removed or blocked since it was cached, search again
+                logger.warning(f"Cached video {video_url} failed, searching again: {e}")
+                delete_cached_url(query)
+                video_url = None
+            else:
+                entry = ydl.process_ie_result(info, download=True)
+        if entry is None:
+            wait_for_search_slot()
+            try:
+                video_url = search_youtube_music(query)
+            except Exception as e:
+                logger.warning(f"YouTube Music search failed: {e}")
+            if video_url:
                 logger.info(f"Found video: {video_url}")
-                ydl.download([video_url])
-                if os.path.exists(final_path):
-                    return final_path
+                set_cached_url(query, video_url)
+                entry = ydl.extract_info(video_url, download=True)
+            else:
+                # Fall back to a regular YouTube search, downloading the top result in the same extraction
+                wait_for_search_slot()
+                info = ydl.extract_info(f"ytsearch1:{query}", download=True)
+                entry = info["entries"][0] if info.get("entries") else None
+                if entry:
+                    video_url = entry.get("webpage_url")
+                    logger.info(f"Found video: {video_url}")
+                    if video_url:
+                        set_cached_url(query, video_url)
+        if entry:
+            path = ydl.prepare_filename(entry)
+            if os.path.exists(path):
+                return path
     except Exception as e:
         logger.error(f"Error downloading song: {e}")
+        if deadline_passed():
+            # Otherwise yt_dlp would pick the partial file up as finished on the next run
+            remove_partial_download(downloads_dir, base_filename)
     return None
 
-def get_items_from_spotify(sp, url_type, spotify_id):
+def find_ffmpeg(ffmpeg_path="ast"):
+    """Return the ffmpeg executable inside ffmpeg_path, or the one on PATH."""
+    return shutil.which("ffmpeg", path=ffmpeg_path) or shutil.which("ffmpeg") or "ffmpeg"
+
+def convert_to_mp3(src, ffmpeg_path="ast"):
+    """
+    Convert a downloaded audio file to a 192k mp3 next to it and remove the original.
+    Returns the path of the mp3 (or None if the conversion fails).
+    """
+    if src is None:
+        return None
+    dst = os.path.splitext(src)[0] + ".mp3"
+    if src == dst:
+        return dst
+    try:
+        subprocess.run([find_ffmpeg(ffmpeg_path), "-y", "-loglevel", "error", "-i", src,
+                        "-vn", "-b:a", "192k", dst], check=True, timeout=_track_timeout or None)
+        os.remove(src)
+        return dst
+    except Exception as e:
+        logger.error(f"Error converting {src} to mp3: {e}")
+        # Don't leave a half written mp3 behind, it would be taken as done on the next run
+        if os.path.exists(dst):
+            os.remove(dst)
+    return None
+
+PLAYLIST_ITEM_FIELDS = "items(track(id,name,artists(name),album(name))),next,total"
+
+def tag_tracks(done):
     """
-    Given a Spotify URL type and ID, returns a tuple (items, name)
-    - For a track: items is a list with one track object and name is the track's title.
-    - For an album: items is a list of track objects (retrieved via sp.track) and name is the album name.
-    - For a playlist: items is a list of track objects and name is the playlist name.
+    Write title, artist and album ID3 tags for a list of (mp3 path, Spotify track object) pairs.
+    Runs after all downloads have finished so tagging stays off the download path.
+    """
+    for path, track in done:
+        try:
+            try:
+                tags = EasyID3(path)
+            except ID3NoHeaderError:
+                tags = EasyID3()
+            tags["title"] = track.get("name", "")
+            tags["artist"] = [a["name"] for a in track.get("artists", [])]
+            album = (track.get("album") or {}).get("name")
+            if album:
+                tags["album"] = album
+            tags.save(path, v2_version=3, padding=lambda info: 0)
+        except Exception as e:
+            logger.error(f"Error tagging {path}: {e}")
+
+def get_collection_info(sp, url_type, spotify_id):
+    """
+    Given a Spotify URL type and ID, returns a tuple (name, total)
+    where name is the track, album or playlist name and total is its number of tracks.
     """
-    items = []
-    name = ""
     try:
         if url_type == "track":
-            track = sp.track(spotify_id)
-            items.append(track)
-            name = track.get("name", "Unknown Track")
+            track = cached_call("track", spotify_id, lambda: sp.track(spotify_id))
+            return track.get("name", "Unknown Track"), 1
         elif url_type == "album":
-            album = sp.album(spotify_id)
-            name = album.get("name", "Unknown Album")
-            album_tracks = sp.album_tracks(spotify_id)['items']
-            # For each track, retrieve full details
-            for track_info in album_tracks:
-                tid = track_info.get("id")
-                if tid:
-                    track_obj = sp.track(tid)
-                    items.append(track_obj)
+            album = cached_call("album", spotify_id, lambda: sp.album(spotify_id))
+            return album.get("name", "Unknown Album"), album.get("total_tracks", 0)
         elif url_type == "playlist":
-            playlist = sp.playlist(spotify_id)
-            name = playlist.get("name", "Unknown Playlist")
-            for item in playlist["tracks"]["items"]:
-                track_obj = item.get("track")
-                if track_obj:
-                    items.append(track_obj)
+            playlist = cached_call("playlist", f"{spotify_id}:info",
+                                   lambda: sp.playlist(spotify_id, fields="name,tracks.total"))
+            return playlist.get("name", "Unknown Playlist"), playlist["tracks"].get("total", 0)
+        raise ValueError("Unknown Spotify URL type encountered.")
+    except Exception as e:
+        logger.error(f"Error fetching items from Spotify: {e}")
+        raise
+
+def yield_tracks(sp, url_type, spotify_id):
+    """
+    Yield the full track objects of a Spotify track, album or playlist as each page arrives,
+    so downloads can start before the whole collection has been fetched.
+    - For an album: tracks are paged 50 at a time and retrieved in batches via sp.tracks.
+    - For a playlist: playlist pages are followed with sp.next.
+    """
+    try:
+        if url_type == "track":
+            yield cached_call("track", spotify_id, lambda: sp.track(spotify_id))
+        elif url_type == "album":
+            offset = 0
+            while True:
+                page = cached_call("album_tracks", f"{spotify_id}:{offset}",
+                                   lambda: sp.album_tracks(spotify_id, limit=50, offset=offset))
+                # Retrieve full details in one batch (the API allows 50 ids per request)
+                track_ids = [t["id"] for t in page["items"] if t.get("id")]
+                if track_ids:
+                    batch = cached_call("tracks", ",".join(track_ids), lambda: sp.tracks(track_ids))
+                    for track_obj in batch["tracks"]:
+                        if track_obj:
+                            yield track_obj
+                if not page.get("next"):
+                    break
+                offset += len(page["items"])
+        elif url_type == "playlist":
+            # Only ask for the fields we use, full track objects are mostly market lists and artwork
+            results = cached_call("playlist", f"{spotify_id}:items",
+                                  lambda: sp.playlist_items(spotify_id, fields=PLAYLIST_ITEM_FIELDS,
+                                                            additional_types=("track",), limit=100))
+            while results:
+                for item in results["items"]:
+                    track_obj = item.get("track")
+                    if track_obj:
+                        yield track_obj
+                next_url = results.get("next")
+                results = cached_call("playlist", next_url, lambda: sp.next(results)) if next_url else None
         else:
             raise ValueError("Unknown Spotify URL type encountered.")
-        logger.info(f"Found {len(items)} track(s) in {url_type} '{name}'")
     except Exception as e:
         logger.error(f"Error fetching items from Spotify: {e}")
         raise
-    return items, name
+
+def non_negative_float(value):
+    """argparse type for options where 0 means 'no limit' and negative values make no sense."""
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or more, got {value}")
+    return number
+
+def positive_int(value):
+    """argparse type for counts that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be 1 or more, got {value}")
+    return number
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Download Spotify tracks, albums and playlists from YouTube.")
+    parser.add_argument("url", nargs="?",
+                        help="Spotify track, album or playlist URL (asked for interactively if omitted)")
+    parser.add_argument("--workers", type=positive_int, default=DEFAULT_WORKERS,
+                        help=f"number of concurrent downloads (default: {DEFAULT_WORKERS})")
+    parser.add_argument("--search-rps", type=non_negative_float, default=DEFAULT_SEARCH_RPS,
+                        help=f"maximum YouTube searches per second, 0 for no limit (default: {DEFAULT_SEARCH_RPS})")
+    parser.add_argument("--timeout", type=non_negative_float, default=DEFAULT_TRACK_TIMEOUT,
+                        help=f"seconds to allow for downloading or converting one track, 0 for no limit "
+                             f"(default: {DEFAULT_TRACK_TIMEOUT}); with --aria2 only the conversion is "
+                             f"limited, aria2c drops stalled transfers on its own")
+    parser.add_argument("--aria2", action="store_true",
+                        help="download with aria2c (must be on PATH) using several connections per file")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+    set_search_rate(args.search_rps)
+    set_track_timeout(args.timeout)
+    if args.aria2:
+        enable_aria2()
+
     # Here go the credentials, between the ""
     client_id = ""
     client_secret = ""
+    # Share one keep-alive connection pool between the token and API requests.
+    # Spotify is only called from the main thread, so one connection per host is enough.
+    # Passing our own session skips spotipy's retry setup, so retry 429s and 5xx like it does.
+    retry = Retry(total=3, status=3, backoff_factor=0.3,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset({"GET", "POST"}))
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=2, max_retries=retry))
     sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=client_id,
-                                                               client_secret=client_secret))
+                                                               client_secret=client_secret,
+                                                               requests_session=session),
+                         requests_session=session)
     
-    spotify_url = input("Enter Spotify URL (track/album/playlist): ").strip()
+    spotify_url = args.url or input("Enter Spotify URL (track/album/playlist): ")
+    spotify_url = spotify_url.strip()
     url_type, spotify_id = extract_spotify_id(spotify_url)
     if not url_type or not spotify_id:
         logger.error("Invalid Spotify URL.")
         return
     
     try:
-        items, collection_name = get_items_from_spotify(sp, url_type, spotify_id)
+        collection_name, total = get_collection_info(sp, url_type, spotify_id)
     except Exception as e:
         logger.error(f"Failed to fetch items: {e}")
         return
@@ -131,15 +537,18 @@ def main():
         os.makedirs(downloads_dir)
     
     # If a single track, download directly to downloads folder.
-    if url_type == "track" or len(items) == 1:
-        track = items[0]
-        query = build_query(track)
-        logger.info(f"Search query: {query}")
-        artist = ", ".join([a["name"] for a in track.get("artists", [])])
-        title = track.get("name", "")
-        base_filename = sanitize_filename(f"{artist} - {title}")
-        output_path = download_song(query, downloads_dir, base_filename, ffmpeg_path="ast")
+    if url_type == "track" or total == 1:
+        try:
+            track = next(yield_tracks(sp, url_type, spotify_id))
+        except Exception as e:
+            logger.error(f"Failed to fetch items: {e}")
+            return
+        meta = to_meta(track)
+        logger.info(f"Search query: {meta.query}")
+        output_path = convert_to_mp3(download_song(meta.query, downloads_dir, meta.base_filename, ffmpeg_path="ast"),
+                                     ffmpeg_path="ast")
         if output_path:
+            tag_tracks([(output_path, track)])
             logger.info(f"Downloaded song to {output_path}")
         else:
             logger.error("Failed to download the song.")
@@ -149,24 +558,62 @@ def main():
         if not os.path.exists(collection_folder):
             os.makedirs(collection_folder)
         
-        logger.info(f"Downloading {len(items)} tracks into folder '{collection_folder}'")
+        # List the folder once instead of checking every track's file separately.
+        # Empty files are left out so they get downloaded again, like already_downloaded does.
+        existing = {entry.name for entry in os.scandir(collection_folder)
+                    if entry.is_file() and entry.name.endswith(".mp3") and entry.stat().st_size > 0}
         
-        def process_track(track):
-            q = build_query(track)
-            artist = ", ".join([a["name"] for a in track.get("artists", [])])
-            title = track.get("name", "")
-            base_fn = sanitize_filename(f"{artist} - {title}")
-            logger.info(f"Downloading track: {base_fn}")
-            return download_song(q, collection_folder, base_fn, ffmpeg_path="ast")
+        logger.info(f"Downloading {total} tracks from {url_type} '{collection_name}' into folder '{collection_folder}'")
+        
+        def process_track(meta):
+            logger.info(f"Downloading track: {meta.base_filename}")
+            return download_song(meta.query, collection_folder, meta.base_filename, ffmpeg_path="ast")
         
         downloaded = []
-        # You can use a ThreadPoolExecutor for concurrent downloads if desired.
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(process_track, track) for track in items]
-            for future in futures:
+        # Two stage pipeline: download threads only fetch audio, and each finished download
+        # is handed to the encode pool so ffmpeg runs while the next tracks are downloading.
+        # ffmpeg is its own process, so a thread per encode is enough to use every core.
+        with ThreadPoolExecutor(max_workers=args.workers) as executor, \
+                ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as encoder:
+            # Map each download / encode future to its Spotify track for tagging afterwards
+            futures = {}
+            # Tracks that appear more than once would be written to the same file, only fetch them once
+            seen = set()
+            try:
+                # Submit each track as soon as its page arrives from Spotify
+                for track in yield_tracks(sp, url_type, spotify_id):
+                    meta = to_meta(track)
+                    # Local files in a playlist have no id, for those only the file name counts
+                    if (meta.id is not None and meta.id in seen) or meta.base_filename in seen:
+                        logger.info(f"Skip duplicate {meta.base_filename}")
+                        continue
+                    if meta.id is not None:
+                        seen.add(meta.id)
+                    seen.add(meta.base_filename)
+                    # Don't occupy a worker slot for tracks that are already on disk
+                    final_path = os.path.join(collection_folder, f"{meta.base_filename}.mp3")
+                    if f"{meta.base_filename}.mp3" in existing:
+                        logger.info(f"Skip existing {final_path}")
+                        downloaded.append(final_path)
+                        continue
+                    futures[executor.submit(process_track, meta)] = track
+            except Exception as e:
+                # Keep whatever was already queued
+                logger.error(f"Failed to fetch items: {e}")
+            encodes = {}
+            for future in as_completed(futures):
+                raw_path = future.result()
+                if raw_path:
+                    encodes[encoder.submit(convert_to_mp3, raw_path, "ast")] = futures[future]
+            done = []
+            for future in as_completed(encodes):
                 result = future.result()
                 if result:
                     downloaded.append(result)
+                    done.append((result, encodes[future]))
+        
+        # Tag the new files in one pass, files that were already there are left alone
+        tag_tracks(done)
         
         if downloaded:
             logger.info(f"Successfully downloaded {len(downloaded)} tracks to '{collection_folder}'")
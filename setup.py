@@ -6,27 +6,22 @@ import subprocess
 LIBS_DIR = os.path.join(os.getcwd(), "libs")
 if not os.path.exists(LIBS_DIR):
     os.makedirs(LIBS_DIR)
+sys.path.insert(0, LIBS_DIR)
 
-# List of required packages
-required_packages = [
-    "spotipy",
-    "yt-dlp",
-    "youtube-search-python",
-    "mutagen",
-    "flask",
-    "requests"
-]
+# The required packages are listed in requirements.txt
+REQUIREMENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "requirements.txt")
 
-def install_packages(packages):
-    for pkg in packages:
-        try:
-            __import__(pkg.replace('-', '_'))
-            print(f"{pkg} is already installed.")
-        except ImportError:
-            print(f"Installing {pkg} into {LIBS_DIR} ...")
-            subprocess.check_call([sys.executable, "-m", "pip", "install", "--target=" + LIBS_DIR, pkg])
+def install_packages():
+    try:
+        import spotipy, yt_dlp, ytmusicapi, mutagen, requests
+        print("All packages are already installed.")
+    except ImportError:
+        # One pip run resolves and installs everything at once
+        print(f"Installing requirements into {LIBS_DIR} ...")
+        subprocess.check_call([sys.executable, "-m", "pip", "install", "--target", LIBS_DIR, "-r", REQUIREMENTS])
 
-install_packages(required_packages)
+install_packages()
 print("All dependencies installed/updated in the 'libs' folder.")
 print("Launching main application...")
-subprocess.check_call([sys.executable, "main.py"])
+env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [LIBS_DIR, os.environ.get("PYTHONPATH")])))
+subprocess.check_call([sys.executable, "main.py"] + sys.argv[1:], env=env)